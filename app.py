@@ -1,94 +1,216 @@
 import streamlit as st
 import fitz
-import re
+import ahocorasick
+import hashlib
 from pathlib import Path
-import base64
+import os
+import secrets
+import shutil
+import time
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate
+from multiprocessing import get_all_start_methods, get_context
+from urllib.parse import quote
+
+from pdf_workers import (
+    clean_text, extract_page, init_worker, locate_page, page_areas, page_text, trim_store, worker_main,
+)
 
 st.set_page_config(page_title="Patent Analyzer", page_icon="🔬", layout="wide")
 
 # Setup
 BASE = Path.cwd()
 PATENTS = BASE / "Patents"
-HIGHLIGHTED = BASE / "highlighted"
+# Streamlit serves this folder at app/static/, so the viewer can link to files
+HIGHLIGHTED = Path(__file__).parent / "static"
 PATENTS.mkdir(exist_ok=True)
 HIGHLIGHTED.mkdir(exist_ok=True)
 
+# Pages handed to a worker at a time
+PAGE_BATCH = 8
+
+# Bytes copied per write when saving an upload
+UPLOAD_CHUNK = 16 * 1024 * 1024
+
+# Largest file Streamlit's static serving will send (its MAX_APP_STATIC_FILE_SIZE)
+STATIC_PREVIEW_LIMIT = 200 * 1024 * 1024
+
+# Highlight appearance
+HIGHLIGHT_COLOR = (1.0, 1.0, 0.0)
+HIGHLIGHT_OPACITY = 0.4
+
+# Joins page texts in the search index
+PAGE_SEP = '\x01'
+
+# Seconds a highlighted file is kept after its last write; Streamlit has no session-end hook
+HIGHLIGHT_TTL = 60 * 60
+
 # ============================================================================
 # CORE SEARCH - HANDLES PUNCTUATION
 # ============================================================================
 
-def search_pdf(pdf_path, keywords):
+def _mp_context():
+    """Start workers without forking Streamlit's threaded server process"""
+    if 'forkserver' not in get_all_start_methods():
+        return get_context('spawn')
+    ctx = get_context('forkserver')
+    # The default preload imports __main__, i.e. would run this UI script in the server
+    ctx.set_forkserver_preload(['pdf_workers'])
+    return ctx
+
+def _pool(pdf_path, tasks):
+    """Process pool sized to the machine, never larger than the work"""
+    batches = -(-tasks // PAGE_BATCH)
+    return ProcessPoolExecutor(
+        max_workers=max(1, min(os.cpu_count() or 1, batches)),
+        mp_context=_mp_context(),
+        initializer=init_worker,
+        initargs=(pdf_path,),
+    )
+
+def _map_pages(pdf_path, fn, tasks):
+    """Run a pdf_workers page function over tasks in a process pool"""
+    with _pool(pdf_path, len(tasks)) as pool:
+        # map submits every batch, so all workers have started by the time it returns
+        with worker_main():
+            results = pool.map(fn, tasks, chunksize=PAGE_BATCH)
+        return list(results)
+
+def extract_page_texts(pdf_path, page_count):
+    """Normalised text of every page, extracted in parallel"""
+    # A single batch costs less than starting a pool for it
+    if page_count <= PAGE_BATCH:
+        with fitz.open(pdf_path) as doc:
+            return [page_text(page) for page in doc]
+    # The workers open their own handles, so no document is opened here
+    return _map_pages(pdf_path, extract_page, range(page_count))
+
+def build_index(page_texts):
+    """All page texts joined into one string, plus the offset where each page starts"""
+    # '\x01' never survives clean_text, so no keyword can match across a page boundary
+    blob = PAGE_SEP.join(page_texts)
+    starts = list(accumulate((len(text) + 1 for text in page_texts[:-1]), initial=0))
+    return blob, starts
+
+def search_pdf(index, keywords):
     """Search that ignores punctuation"""
-    doc = fitz.open(str(pdf_path))
+    blob, starts = index
     results = {}
+    # Cleaned keyword -> result dicts it feeds, so the scan skips the results[kw] lookups
+    by_clean = {}
     
     for kw in keywords:
-        results[kw] = {'found': False, 'pages': [], 'count': 0}
-    
-    for page_num in range(doc.page_count):
-        page = doc.load_page(page_num)
-        text = page.get_text().lower()
-        
-        # Strip punctuation from page text
-        text_no_punct = re.sub(r'[^\w\s]', ' ', text)
-        text_clean = ' '.join(text_no_punct.split())
+        results[kw] = {'found': False, 'pages': set(), 'count': 0}
         
-        for kw in keywords:
-            # Strip punctuation from keyword
-            kw_no_punct = re.sub(r'[^\w\s]', ' ', kw.lower())
-            kw_clean = ' '.join(kw_no_punct.split())
-            
-            if kw_clean in text_clean:
-                results[kw]['found'] = True
-                results[kw]['count'] += text_clean.count(kw_clean)
-                if page_num + 1 not in results[kw]['pages']:
-                    results[kw]['pages'].append(page_num + 1)
+        # Strip punctuation from keyword
+        kw_clean = clean_text(kw)
+        if kw_clean:
+            by_clean.setdefault(kw_clean, []).append(results[kw])
+    
+    automaton = ahocorasick.Automaton()
+    for kw_clean in by_clean:
+        automaton.add_word(kw_clean, kw_clean)
+    automaton.make_automaton()
+    
+    if by_clean:
+        # One pass over the whole document finds every keyword; skip overlaps so counts match str.count
+        last_end = {}
+        for end, kw_clean in automaton.iter(blob):
+            if end - len(kw_clean) >= last_end.get(kw_clean, -1):
+                last_end[kw_clean] = end
+                page = bisect_right(starts, end)
+                for r in by_clean[kw_clean]:
+                    r['found'] = True
+                    r['count'] += 1
+                    r['pages'].add(page)
     
-    doc.close()
+    for r in results.values():
+        r['pages'] = sorted(r['pages'])
     
     found = sum(1 for r in results.values() if r['found'])
     match_pct = (found / len(keywords) * 100) if keywords else 0
     
     return results, match_pct
 
-def highlight_pdf(pdf_path, output_path, keywords):
-    """Highlight with punctuation handling"""
-    doc = fitz.open(str(pdf_path))
-    total = 0
+def locate_highlights(pdf_path, results):
+    """Highlight areas per page, plus the number of keyword occurrences they cover"""
+    # Only visit the pages where the search pass found each keyword
+    page_keywords = {}
+    for kw, data in results.items():
+        if data['found']:
+            for page in data['pages']:
+                page_keywords.setdefault(page - 1, []).append(kw)
+    jobs = sorted(page_keywords.items())
     
-    for page_num in range(doc.page_count):
-        page = doc.load_page(page_num)
-        
-        for kw in keywords:
-            # Try exact match
-            areas = page.search_for(kw)
-            
-            # Try with punctuation variations
-            if not areas:
-                variations = [
-                    f'"{kw}"', f'"{kw}', f'{kw}"',
-                    f'"{kw},"', f'"{kw}.',
-                    f'{kw},', f'{kw}.', f'{kw};',
-                    f'({kw})', f'({kw},', f'({kw}.',
-                    f"'{kw}'", f"'{kw},", f"'{kw}.",
-                ]
-                
-                for var in variations:
-                    areas = page.search_for(var)
-                    if areas:
-                        break
+    if len(jobs) <= PAGE_BATCH:
+        with fitz.open(pdf_path) as doc:
+            located = [(page_num, page_areas(doc.load_page(page_num), keywords))
+                       for page_num, keywords in jobs]
+    else:
+        located = _map_pages(pdf_path, locate_page, jobs)
+    total = sum(count for _, rects in located for _, count in rects)
+    return located, total
+
+def highlight_pdf(pdf_path, output_path, located):
+    """Write the located areas into a highlighted copy of the document"""
+    # Annotations are written here so MuPDF writes stay single-process
+    doc = fitz.open(pdf_path)
+    try:
+        for page_num, rects in located:
+            page = doc.load_page(page_num)
             
-            # Highlight
-            for area in areas:
-                highlight = page.add_highlight_annot(area)
-                highlight.set_colors(stroke=[1, 1, 0])
-                highlight.set_opacity(0.4)
+            # Highlight - one annotation per keyword, so its appearance is built once
+            for kw_rects, _ in rects:
+                highlight = page.add_highlight_annot(quads=[fitz.Rect(rect) for rect in kw_rects])
+                highlight.set_colors(stroke=HIGHLIGHT_COLOR)
+                highlight.set_opacity(HIGHLIGHT_OPACITY)
                 highlight.update()
-                total += 1
+            trim_store()
+        
+        # Drop unused objects and compress streams so the served file stays small
+        doc.save(str(output_path), garbage=3, deflate=True)
+    finally:
+        doc.close()
+
+def prune_highlighted():
+    """Delete highlighted files older than HIGHLIGHT_TTL from the served folder"""
+    cutoff = time.time() - HIGHLIGHT_TTL
+    for path in HIGHLIGHTED.glob("highlighted_*.pdf"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            # Another session pruned it first
+            pass
+
+def file_hash(f):
+    """Content hash identifying an upload, whatever its name"""
+    # Chunked by hand; hashlib.file_digest would need Python 3.11
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in iter(lambda: f.read(UPLOAD_CHUNK), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def analyze_pdf(pdf_hash, keywords, _pdf_path, _page_count, _text_cache):
+    """Search and locate highlights, memoised on the file's content hash and the keywords"""
+    # Only data is cached; each session writes its own highlighted file, so
+    # evicted entries leave nothing behind in the served folder
+    pdf_path = str(_pdf_path)
+    
+    # Underscored arguments are not hashed. _text_cache holds the session's search index,
+    # built on the first run only
+    if 'index' not in _text_cache:
+        _text_cache['index'] = build_index(extract_page_texts(pdf_path, _page_count))
     
-    doc.save(str(output_path))
-    doc.close()
-    return total
+    results, match = search_pdf(_text_cache['index'], list(keywords))
+    
+    located, highlights = [], 0
+    if any(v['found'] for v in results.values()):
+        located, highlights = locate_highlights(pdf_path, results)
+    
+    return results, match, located, highlights
 
 # ============================================================================
 # UI
@@ -110,6 +232,12 @@ st.markdown('<div class="subtitle"> keyword search engine </div>', unsafe_allow_
 
 if 'analyzed' not in st.session_state:
     st.session_state.analyzed = False
+if 'highlighted_path' not in st.session_state:
+    # One output per session, overwritten by each analysis
+    st.session_state.highlighted_path = HIGHLIGHTED / f"highlighted_{secrets.token_hex(8)}.pdf"
+
+# Ended sessions leave their file behind
+prune_highlighted()
 
 col1, col2, col3 = st.columns([1, 1.2, 1.2])
 
@@ -123,17 +251,38 @@ with col1:
     uploaded = st.file_uploader("Choose PDF file", type=['pdf'])
     
     if uploaded:
-        pdf_path = PATENTS / uploaded.name
-        with open(pdf_path, 'wb') as f:
-            f.write(uploaded.getbuffer())
-        
-        doc = fitz.open(str(pdf_path))
-        pages = doc.page_count
-        size_mb = len(uploaded.getvalue()) / (1024 * 1024)
-        doc.close()
+        # Reruns keep the same upload, so only save and inspect it once
+        if st.session_state.get('upload_id') != uploaded.file_id:
+            uploaded.seek(0)
+            pdf_hash = file_hash(uploaded)
+            # Named by content, so another session uploading a same-named file
+            # can't change what the cached results for this hash point at
+            pdf_path = PATENTS / f"{pdf_hash}.pdf"
+            if not pdf_path.exists():
+                # Copy in chunks; getvalue() would build a second full-size bytes object
+                part_path = PATENTS / f"{pdf_hash}.{uploaded.file_id}.part"
+                uploaded.seek(0)
+                try:
+                    with open(part_path, 'wb') as f:
+                        shutil.copyfileobj(uploaded, f, length=UPLOAD_CHUNK)
+                    os.replace(part_path, pdf_path)
+                except BaseException:
+                    # Full disk, dropped upload or a rerun stopping the script mid-copy
+                    part_path.unlink(missing_ok=True)
+                    raise
+            st.session_state.pdf_hash = pdf_hash
+            
+            doc = fitz.open(str(pdf_path))
+            st.session_state.page_count = doc.page_count
+            doc.close()
+            
+            st.session_state.upload_id = uploaded.file_id
+            st.session_state.text_cache = {}
+            st.session_state.size_mb = pdf_path.stat().st_size / (1024 * 1024)
+            st.session_state.pdf_path = pdf_path
+            st.session_state.pdf_name = uploaded.name
         
-        st.success(f"✅ {pages} pages | {size_mb:.1f} MB")
-        st.session_state.pdf_path = pdf_path
+        st.success(f"✅ {st.session_state.page_count} pages | {st.session_state.size_mb:.1f} MB")
     else:
         st.info("📤 Upload a PDF")
         st.markdown("""
@@ -177,19 +326,24 @@ with col2:
                 kw_list = [k.strip() for k in keywords.split('\n') if k.strip()]
                 
                 with st.spinner("Analyzing..."):
-                    results, match = search_pdf(st.session_state.pdf_path, kw_list)
-                    
-                    out_path = HIGHLIGHTED / f"highlighted_{st.session_state.pdf_path.name}"
-                    found_kw = [k for k, v in results.items() if v['found']]
+                    results, match, located, highlights = analyze_pdf(
+                        st.session_state.pdf_hash, tuple(kw_list), st.session_state.pdf_path,
+                        st.session_state.page_count, st.session_state.text_cache
+                    )
                     
-                    highlights = 0
-                    if found_kw:
-                        highlights = highlight_pdf(st.session_state.pdf_path, out_path, found_kw)
+                    # Rewrite the session's file only when it holds another analysis or was pruned
+                    out_path = st.session_state.highlighted_path
+                    analysis = (st.session_state.pdf_hash, tuple(kw_list))
+                    if st.session_state.get('highlighted_for') != analysis or not out_path.exists():
+                        if located:
+                            highlight_pdf(str(st.session_state.pdf_path), out_path, located)
+                        else:
+                            out_path.unlink(missing_ok=True)
+                        st.session_state.highlighted_for = analysis
                     
                     st.session_state.analyzed = True
                     st.session_state.results = results
                     st.session_state.match_pct = match
-                    st.session_state.highlighted_path = out_path
                     st.session_state.highlights = highlights
                     
                 st.success("✅ Analysis complete!")
@@ -241,33 +395,45 @@ with col2:
 # COLUMN 3: VIEWER
 # ============================================================================
 
+def pdf_bytes(path, mtime_ns):
+    """File contents for the download button, re-read only when the file changes"""
+    # Held in session state rather than a global cache, so the bytes go when the session does
+    key = (path, mtime_ns)
+    if st.session_state.get('pdf_bytes_key') != key:
+        st.session_state.pdf_bytes = Path(path).read_bytes()
+        st.session_state.pdf_bytes_key = key
+    return st.session_state.pdf_bytes
+
 with col3:
     st.markdown('<div class="header">📄 PDF VIEWER</div>', unsafe_allow_html=True)
     
-    if st.session_state.analyzed and 'highlighted_path' in st.session_state:
+    if st.session_state.analyzed:
         pdf_path = st.session_state.highlighted_path
         
         if pdf_path.exists():
-            # Download
-            with open(pdf_path, "rb") as f:
-                st.download_button(
-                    "⬇️ Download Highlighted PDF",
-                    f,
-                    file_name=pdf_path.name,
-                    mime="application/pdf",
-                    use_container_width=True
-                )
+            stat = pdf_path.stat()
+            mtime_ns = stat.st_mtime_ns
             
-            # Viewer
-            with open(pdf_path, "rb") as f:
-                base64_pdf = base64.b64encode(f.read()).decode('utf-8')
-            
-            st.markdown(
-                f'<iframe src="data:application/pdf;base64,{base64_pdf}" width="100%" height="700px" type="application/pdf"></iframe>',
-                unsafe_allow_html=True
+            # Download
+            st.download_button(
+                "⬇️ Download Highlighted PDF",
+                pdf_bytes(str(pdf_path), mtime_ns),
+                file_name=f"highlighted_{st.session_state.pdf_name}",
+                mime="application/pdf",
+                use_container_width=True
             )
             
-            st.caption("💡 Best in Edge/Firefox. Use Download if preview fails.")
+            # Viewer - served as a static file rather than inlined as base64; the file name is
+            # reused, so the version parameter keeps the browser from showing a stale copy
+            if stat.st_size > STATIC_PREVIEW_LIMIT:
+                st.info(f"📄 {stat.st_size / (1024 * 1024):.0f} MB is too large to preview here. Download to view.")
+            else:
+                st.markdown(
+                    f'<iframe src="app/static/{quote(pdf_path.name)}?v={mtime_ns}" width="100%" height="700px" type="application/pdf"></iframe>',
+                    unsafe_allow_html=True
+                )
+                
+                st.caption("💡 Best in Edge/Firefox. Use Download if preview fails.")
     else:
         st.info("📄 PDF will appear after analysis")
 
@@ -0,0 +1,161 @@
+# Page-level work for the process pool in app.py. Kept out of the Streamlit
+# script so workers import it by name instead of re-running the UI.
+import re
+import sys
+import threading
+import types
+from bisect import bisect_right
+from contextlib import contextmanager
+from itertools import accumulate
+
+import fitz
+
+# Pages between shrinks of MuPDF's resource store. Its size can't be read (current
+# PyMuPDF returns None from TOOLS.store_size), so shrink on a page count instead
+TRIM_EVERY = 32
+
+# Extraction flags. Both keep line-end hyphens ('non-' / 'transitory' cleans to
+# 'non transitory'); the locator's word index finds what search_for misses that way
+TEXT_FLAGS = fitz.TEXTFLAGS_TEXT
+SEARCH_FLAGS = fitz.TEXTFLAGS_SEARCH & ~fitz.TEXT_DEHYPHENATE
+
+# Anything that is not a word character or whitespace
+_PUNCT_RE = re.compile(r'[^\w\s]')
+
+def clean_text(text):
+    """Lowercase, strip punctuation and collapse whitespace"""
+    return ' '.join(_PUNCT_RE.sub(' ', text.lower()).split())
+
+_pages_since_trim = 0
+
+def trim_store():
+    """Keep MuPDF's cached fonts/images bounded on image-heavy patents; call once per page"""
+    global _pages_since_trim
+    _pages_since_trim += 1
+    if _pages_since_trim >= TRIM_EVERY:
+        _pages_since_trim = 0
+        fitz.TOOLS.store_shrink(50)
+
+# Stands in for Streamlit's script module while workers start. Its __main__ has a
+# __file__ and no __spec__, so multiprocessing would re-run app.py in every worker
+_WORKER_MAIN = types.ModuleType('__main__')
+# Script runs of different sessions share sys.modules
+_MAIN_LOCK = threading.Lock()
+
+@contextmanager
+def worker_main():
+    """Hide the Streamlit script from workers started inside the block"""
+    with _MAIN_LOCK:
+        main = sys.modules['__main__']
+        sys.modules['__main__'] = _WORKER_MAIN
+        try:
+            yield
+        finally:
+            # A session starting its run meanwhile installs its own module; keep that one
+            if sys.modules['__main__'] is _WORKER_MAIN:
+                sys.modules['__main__'] = main
+
+# Each worker process keeps its own handle; fitz documents cannot be shared across processes
+_worker_doc = None
+
+def init_worker(pdf_path):
+    """Open the document once per worker process"""
+    global _worker_doc
+    _worker_doc = fitz.open(pdf_path)
+
+def page_text(page):
+    """Normalised text of one page"""
+    # Strip punctuation from page text
+    text = clean_text(page.get_text(flags=TEXT_FLAGS))
+    trim_store()
+    return text
+
+def extract_page(page_num):
+    """page_text of the worker's document (runs in a worker process)"""
+    return page_text(_worker_doc.load_page(page_num))
+
+def _word_index(page, textpage):
+    """Cleaned words of a page joined into one string, with each word's start offset and box"""
+    tokens = []
+    boxes = []
+    for x0, y0, x1, y1, word, *_ in page.get_text("words", textpage=textpage):
+        # 'image-stream' cleans to two tokens that share the word's box
+        for token in clean_text(word).split():
+            tokens.append(token)
+            boxes.append(fitz.Rect(x0, y0, x1, y1))
+    starts = list(accumulate((len(token) + 1 for token in tokens[:-1]), initial=0))
+    return ' '.join(tokens), starts, boxes
+
+def _word_occurrences(index, kw_clean):
+    """Word boxes covering each occurrence of kw_clean, one list per occurrence"""
+    joined, starts, boxes = index
+    occurrences = []
+    pos = joined.find(kw_clean) if kw_clean else -1
+    while pos != -1:
+        first = bisect_right(starts, pos) - 1
+        last = bisect_right(starts, pos + len(kw_clean) - 1) - 1
+        occurrences.append(boxes[first:last + 1])
+        pos = joined.find(kw_clean, pos + len(kw_clean))
+    return occurrences
+
+def _overlaps(box, area):
+    """Whether a word box and an exact hit share a line, not just a touching edge"""
+    common = box & area
+    return not common.is_empty and common.height > min(box.height, area.height) / 2
+
+def page_areas(page, keywords):
+    """Highlight areas of each keyword on one page, with its occurrence count"""
+    page_rect = page.rect
+    rects = []
+    highlighted_positions = set()
+    
+    # Extract the page once; every search_for and the word index reuse it
+    textpage = page.get_textpage(flags=SEARCH_FLAGS)
+    
+    # MuPDF search ignores case, so keywords differing only in case share a result
+    search_cache = {}
+    
+    def sfind(needle):
+        key = needle.lower()
+        if key not in search_cache:
+            search_cache[key] = page.search_for(needle, textpage=textpage)
+        return search_cache[key]
+    
+    word_index = _word_index(page, textpage)
+    
+    for kw in keywords:
+        # Exact match gives tight areas
+        exact = sfind(kw)
+        
+        # The search pass ignores punctuation, MuPDF does not ('image-stream',
+        # '"image", stream'): add the cleaned-word occurrences the exact search missed
+        occurrences = _word_occurrences(word_index, clean_text(kw))
+        areas = list(exact)
+        for boxes in occurrences:
+            if not any(_overlaps(box, area) for box in boxes for area in exact):
+                areas.extend(boxes)
+        
+        # Count occurrences, not boxes; a multi-word hit spans several boxes or lines
+        count = len(occurrences) or len(exact)
+        
+        # Plain tuples keep the result cheap to pickle; skip areas another keyword already covered
+        kw_rects = []
+        for area in areas:
+            # Clip to the page and drop degenerate areas instead of annotating them
+            area = area & page_rect
+            if area.is_empty:
+                continue
+            position = (int(area.x0 * 10), int(area.y0 * 10), int(area.x1 * 10), int(area.y1 * 10))
+            if position not in highlighted_positions:
+                highlighted_positions.add(position)
+                kw_rects.append(tuple(area))
+        if kw_rects:
+            rects.append((kw_rects, count))
+    
+    trim_store()
+    return rects
+
+def locate_page(job):
+    """page_areas on the worker's document (runs in a worker process)"""
+    page_num, keywords = job
+    return page_num, page_areas(_worker_doc.load_page(page_num), keywords)